@@ -1,15 +1,18 @@
 # main.py
 from pathlib import Path
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 import logging
 import asyncio
-import base64
 import re
-import inspect
+import functools
 import json
-from typing import Dict, Any, Optional
+import orjson
+import random
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
 import time
 import uuid
 
@@ -36,15 +39,23 @@ logging.basicConfig(
 )
 logger = logging.getLogger("voice-agent-pro")
 
-app = FastAPI(title="AI Voice Agent Pro", version="2.0.0")
+app = FastAPI(title="AI Voice Agent Pro", version="2.0.0", default_response_class=ORJSONResponse)
 
 # Mount static files
 BASE_DIR = Path(__file__).resolve().parent.parent
 templates = Jinja2Templates(directory=BASE_DIR / "templates")
 app.mount("/static", StaticFiles(directory=BASE_DIR / "static"), name="static")
 
-# Session storage
-active_sessions: Dict[str, Dict[str, Any]] = {}
+# Compiled once: sentence boundaries in the LLM stream and search triggers
+_SENTENCE_END_RE = re.compile(r'[.?!]+\s')
+_SEARCH_TRIGGER_RE = re.compile(r'\b(latest|today|current|news|price|weather)\b', re.IGNORECASE)
+
+# Number of sentences that may be synthesized or held, unsent, ahead of the sender
+TTS_LOOKAHEAD = 3
+
+# Dedicated pool so TTS calls don't queue behind other blocking work
+# (Gemini calls use llm.LLM_EXECUTOR)
+_TTS_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="tts")
 
 
 @app.get("/")
@@ -60,10 +71,55 @@ async def health_check():
         "status": "healthy",
         "timestamp": time.time(),
         "version": "2.0.0",
-        "active_sessions": len(active_sessions)
+        "active_sessions": len(ws_manager.connections)
     }
 
 
+class SentenceSegmenter:
+    """Incrementally split streamed text into sentences as their boundaries arrive."""
+
+    def __init__(self):
+        self._pending: List[str] = []
+        self._ends_with_terminator = False
+
+    def _take(self, piece: str) -> str:
+        self._pending.append(piece)
+        sentence = "".join(self._pending).strip()
+        self._pending = []
+        return sentence
+
+    def feed(self, chunk: str) -> List[str]:
+        """Scan only the new chunk and return any sentences it completes."""
+        if not chunk:
+            return []
+
+        sentences = []
+        start = 0
+
+        # A terminator at the end of the previous chunk closes on leading whitespace
+        if self._ends_with_terminator and chunk[0].isspace():
+            sentence = self._take("")
+            if sentence:
+                sentences.append(sentence)
+            start = 1
+
+        for match in _SENTENCE_END_RE.finditer(chunk, start):
+            sentence = self._take(chunk[start:match.end()])
+            if sentence:
+                sentences.append(sentence)
+            start = match.end()
+
+        if start < len(chunk):
+            self._pending.append(chunk[start:])
+        self._ends_with_terminator = chunk[-1] in ".?!"
+        return sentences
+
+    def flush(self) -> str:
+        """Return the trailing text once the stream has ended."""
+        self._ends_with_terminator = False
+        return self._take("")
+
+
 class SimpleWebSocketManager:
     """Simplified WebSocket manager."""
 
@@ -77,7 +133,8 @@ class SimpleWebSocketManager:
         self.session_data[session_id] = {
             "connected_at": time.time(),
             "message_count": 0,
-            "chat_history": [],
+            "chat": None,
+            "turn_lock": asyncio.Lock(),
             "api_keys": {},
             "settings": {
                 "voice": "en-US-natalie",
@@ -88,35 +145,42 @@ class SimpleWebSocketManager:
         logger.info(f"WebSocket session {session_id} connected")
 
     async def disconnect(self, session_id: str):
-        if session_id in self.connections:
-            # Cleanup transcriber
-            session = self.session_data.get(session_id)
-            if session and session.get("transcriber"):
-                transcriber = session["transcriber"]
-                try:
-                    if hasattr(transcriber, "close"):
-                        close_method = getattr(transcriber, "close")
-                        if callable(close_method):
-                            if inspect.iscoroutinefunction(close_method):
-                                await close_method()
-                            else:
-                                close_method()
-                except Exception as e:
-                    logger.warning(f"Error closing transcriber: {e}")
+        # Remove the session before awaiting anything, so overlapping
+        # disconnects are no-ops and the transcriber is closed only once
+        websocket = self.connections.pop(session_id, None)
+        session = self.session_data.pop(session_id, None)
+        if websocket is None:
+            return
+
+        # Cleanup transcriber
+        if session and session.get("transcriber"):
+            transcriber = session["transcriber"]
+            try:
+                # close() joins the stream thread, so keep it off the event loop
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(None, transcriber.close)
+            except Exception as e:
+                logger.warning(f"Error closing transcriber: {e}")
 
-            del self.connections[session_id]
-            if session_id in self.session_data:
-                del self.session_data[session_id]
-            logger.info(f"WebSocket session {session_id} disconnected")
+        logger.info(f"WebSocket session {session_id} disconnected")
 
     async def send_message(self, session_id: str, message: dict):
         if session_id in self.connections:
             try:
-                await self.connections[session_id].send_json(message)
+                # Control frames stay text frames; binary frames are reserved for audio
+                await self.connections[session_id].send_text(orjson.dumps(message).decode())
             except Exception as e:
                 logger.error(f"Error sending message to {session_id}: {e}")
                 await self.disconnect(session_id)
 
+    async def send_bytes(self, session_id: str, data: bytes):
+        if session_id in self.connections:
+            try:
+                await self.connections[session_id].send_bytes(data)
+            except Exception as e:
+                logger.error(f"Error sending bytes to {session_id}: {e}")
+                await self.disconnect(session_id)
+
     def get_session(self, session_id: str) -> Dict:
         return self.session_data.get(session_id, {})
 
@@ -137,13 +201,12 @@ async def websocket_endpoint(websocket: WebSocket):
 
     try:
         await ws_manager.connect(websocket, session_id)
-        loop = asyncio.get_event_loop()
+        loop = asyncio.get_running_loop()
 
         async def handle_transcript(text: str):
             """Handle transcript processing."""
             try:
                 session = ws_manager.get_session(session_id)
-                chat_history = session.get("chat_history", [])
                 api_keys = session.get("api_keys", {})
 
                 # Validate API keys
@@ -163,31 +226,74 @@ async def websocket_endpoint(websocket: WebSocket):
                     "text": text
                 })
 
-                # Get LLM response
-                try:
-                    # Use the original agent_response function with API keys
-                    full_response, updated_history = await get_agent_response(
-                        text, chat_history, api_keys
-                    )
-
-                    # Update chat history
-                    ws_manager.update_session(session_id, {"chat_history": updated_history})
-
-                    # Send assistant response
-                    await ws_manager.send_message(session_id, {
-                        "type": "assistant",
-                        "text": full_response
-                    })
-
-                    # Generate TTS
-                    await process_tts(session_id, full_response, session.get("settings", {}), api_keys)
+                # One turn at a time per connection, so a reply is complete in
+                # the chat history before the next message is sent
+                async with session["turn_lock"]:
+                    # Reuse the connection's chat session so only the new turn is sent
+                    chat = session.get("chat")
+                    if chat is None:
+                        chat = llm.create_chat_session(api_keys["gemini"])
+                        ws_manager.update_session(session_id, {"chat": chat})
+
+                    # Stream LLM response, dispatching each sentence to TTS as it closes.
+                    # At most TTS_LOOKAHEAD sentences are synthesized or waiting to be
+                    # sent at once; the queue keeps their audio in sentence order.
+                    settings = session.get("settings", {})
+                    tts_slots = asyncio.Semaphore(TTS_LOOKAHEAD)
+                    audio_tasks: asyncio.Queue = asyncio.Queue()
+
+                    async with asyncio.TaskGroup() as tg:
+                        tg.create_task(send_tts_audio(session_id, audio_tasks, tts_slots))
+
+                        def dispatch(sentence: str):
+                            audio_tasks.put_nowait(
+                                tg.create_task(synthesize_sentence(session_id, sentence, settings, tts_slots))
+                            )
+
+                        history_before = list(chat.history)
+                        try:
+                            segmenter = SentenceSegmenter()
+                            response_parts = []
+                            async for chunk in stream_agent_response(text, chat, api_keys):
+                                response_parts.append(chunk)
+
+                                sentences = segmenter.feed(chunk)
+                                for sentence in sentences:
+                                    dispatch(sentence)
+                                if sentences:
+                                    # Cumulative text so far; the final "assistant" frame follows
+                                    await ws_manager.send_message(session_id, {
+                                        "type": "assistant_partial",
+                                        "text": "".join(response_parts)
+                                    })
+
+                            # Flush whatever is left after the last sentence boundary
+                            tail = segmenter.flush()
+                            if tail:
+                                dispatch(tail)
+
+                            full_response = "".join(response_parts).strip()
+
+                            # Send assistant response
+                            await ws_manager.send_message(session_id, {
+                                "type": "assistant",
+                                "text": full_response
+                            })
+
+                            # Bound what gets sent to Gemini on later turns
+                            llm.trim_chat_history(chat)
 
-                except Exception as e:
-                    logger.error(f"Error in agent response: {e}")
-                    await ws_manager.send_message(session_id, {
-                        "type": "error",
-                        "text": "Sorry, I encountered an error processing your request."
-                    })
+                        except Exception as e:
+                            logger.error(f"Error in agent response: {e}")
+                            # Drop the failed exchange so the next turn starts from good history
+                            chat.history = history_before
+                            await ws_manager.send_message(session_id, {
+                                "type": "error",
+                                "text": llm.llm_error_message(e)
+                            })
+                        finally:
+                            # Let already-queued sentences finish playing out
+                            audio_tasks.put_nowait(None)
 
             except Exception as e:
                 logger.error(f"Error in transcript handler: {e}")
@@ -201,25 +307,25 @@ async def websocket_endpoint(websocket: WebSocket):
             logger.info(f"Final transcript for {session_id}: {text}")
             asyncio.run_coroutine_threadsafe(handle_transcript(text), loop)
 
+        # The transcriber only changes on control messages, so resolve its
+        # stream_audio once per configuration rather than once per audio frame
+        stream_audio = None
+
         # Main message loop
         while True:
             try:
                 message = await websocket.receive()
+                audio = message.get("bytes")
 
-                if "bytes" in message:  # Audio data
-                    session = ws_manager.get_session(session_id)
-                    transcriber = session.get("transcriber")
-
-                    if transcriber:
+                if audio:  # Audio data, handed to the transcriber as received (no re-buffering)
+                    if stream_audio:
                         try:
-                            if inspect.iscoroutinefunction(transcriber.stream_audio):
-                                await transcriber.stream_audio(message["bytes"])
-                            else:
-                                transcriber.stream_audio(message["bytes"])
+                            # Non-blocking: only enqueues for the transcriber's stream thread
+                            stream_audio(audio)
                         except Exception as e:
                             logger.error(f"Transcriber error: {e}")
 
-                elif "text" in message:  # Control messages
+                elif message.get("text"):  # Control messages
                     try:
                         data = json.loads(message["text"])
                         await handle_control_message(session_id, data, on_final_transcript)
@@ -229,6 +335,9 @@ async def websocket_endpoint(websocket: WebSocket):
                             "text": "Message received"
                         })
 
+                    transcriber = ws_manager.get_session(session_id).get("transcriber")
+                    stream_audio = transcriber.stream_audio if transcriber else None
+
             except WebSocketDisconnect:
                 logger.info(f"WebSocket {session_id} disconnected by client")
                 break
@@ -249,21 +358,45 @@ async def handle_control_message(session_id: str, data: dict, transcript_callbac
         api_keys = data.get("apiKeys", {})
         settings = data.get("settings", {})
 
+        session = ws_manager.get_session(session_id)
+        previous_chat = session.get("chat")
+        previous_gemini_key = session.get("api_keys", {}).get("gemini")
+
         ws_manager.update_session(session_id, {
             "api_keys": api_keys,
             "settings": settings
         })
 
+        # (Re)build the chat session once per key, carrying over any prior turns;
+        # wait for an in-flight turn so its reply isn't read half-finished
+        if api_keys.get("gemini") and (previous_chat is None or api_keys["gemini"] != previous_gemini_key):
+            async with session["turn_lock"]:
+                try:
+                    history = previous_chat.history if previous_chat else None
+                    chat = llm.create_chat_session(api_keys["gemini"], history=history)
+                    ws_manager.update_session(session_id, {"chat": chat})
+                except Exception as e:
+                    logger.error(f"Failed to initialize chat session: {e}")
+
         # Initialize transcriber with new API key
         if api_keys.get("assembly"):
             try:
-                # Create transcriber with dynamic API key
-                transcriber = stt.AssemblyAIStreamingTranscriber(
-                    api_key=api_keys["assembly"],
-                    on_final_callback=transcript_callback
+                # Create transcriber with dynamic API key; construction waits for the
+                # AssemblyAI connection, so run it off the event loop
+                loop = asyncio.get_running_loop()
+                transcriber = await loop.run_in_executor(
+                    None,
+                    functools.partial(
+                        stt.AssemblyAIStreamingTranscriber,
+                        api_key=api_keys["assembly"],
+                        on_final_callback=transcript_callback
+                    )
                 )
 
+                previous_transcriber = ws_manager.get_session(session_id).get("transcriber")
                 ws_manager.update_session(session_id, {"transcriber": transcriber})
+                if previous_transcriber:
+                    await loop.run_in_executor(None, previous_transcriber.close)
 
                 await ws_manager.send_message(session_id, {
                     "type": "status",
@@ -278,61 +411,96 @@ async def handle_control_message(session_id: str, data: dict, transcript_callbac
                 })
 
 
-async def get_agent_response(query: str, history: list, api_keys: dict):
-    """Get agent response with API key support."""
-    try:
-        # Simple search trigger check
-        search_triggers = ["latest", "today", "current", "news", "price", "weather"]
-        needs_search = any(trigger in query.lower() for trigger in search_triggers)
+async def stream_agent_response(query: str, chat, api_keys: dict):
+    """Stream agent response chunks with API key support."""
+    loop = asyncio.get_running_loop()
+
+    # Simple search trigger check
+    needs_search = _SEARCH_TRIGGER_RE.search(query) is not None
 
-        if needs_search and api_keys.get("serpapi"):
+    if needs_search and api_keys.get("serpapi"):
+        try:
             # Use search (simplified)
             from app.services.search import web_search
-            search_result = web_search(query)
-            enhanced_query = f"Based on this information: {search_result}\n\nAnswer: {query}"
-            response, updated_history = llm.get_llm_response(enhanced_query, history)
-        else:
-            # Use LLM directly
-            response, updated_history = llm.get_llm_response(query, history)
+            search_result = await loop.run_in_executor(llm.LLM_EXECUTOR, web_search, query)
+            query = f"Based on this information: {search_result}\n\nAnswer: {query}"
+        except Exception as e:
+            logger.warning(f"Search failed, using LLM only: {e}")
+
+    # Pull chunks off the blocking Gemini stream without stalling the event loop.
+    # A turn that fails before any text arrived is retried, backing off here
+    # rather than inside an LLM worker thread.
+    for attempt in range(llm.MAX_RETRIES):
+        streamed = False
+        try:
+            stream = llm.send_turn(chat, query)
+            while True:
+                chunk = await loop.run_in_executor(llm.LLM_EXECUTOR, next, stream, None)
+                if chunk is None:
+                    return
+                streamed = True
+                yield chunk
 
-        return response, updated_history
+        except Exception as e:
+            logger.warning(f"LLM turn attempt {attempt + 1} failed: {e}")
+            if streamed or attempt == llm.MAX_RETRIES - 1:
+                raise
+            await asyncio.sleep(min(8, 0.25 * 2 ** attempt) + random.random() * 0.1)
 
-    except Exception as e:
-        logger.error(f"Error in agent response: {e}")
-        return "I apologize, but I encountered an error. Please check your API configuration.", history
 
+async def synthesize_sentence(session_id: str, sentence: str, settings: dict,
+                              slots: asyncio.Semaphore) -> Optional[bytes]:
+    """
+    Generate audio for a single sentence.
 
-async def process_tts(session_id: str, text: str, settings: dict, api_keys: dict):
-    """Process text-to-speech."""
+    Takes a lookahead slot that send_tts_audio releases once the clip is sent.
+    """
+    await slots.acquire()
     try:
-        # Split into sentences
-        sentences = re.split(r'(?<=[.?!])\s+', text.strip())
-
-        for sentence in sentences:
-            if sentence.strip():
-                # Generate audio
-                loop = asyncio.get_event_loop()
-                audio_bytes = await loop.run_in_executor(
-                    None,
-                    tts.speak,
-                    sentence.strip(),
-                    settings.get("voice", "en-US-natalie"),  # ✅ valid voiceId
-                    "mp3"
-                )
-
-                if audio_bytes:
-                    b64_audio = base64.b64encode(audio_bytes).decode("utf-8")
-                    await ws_manager.send_message(session_id, {
-                        "type": "audio",
-                        "b64": b64_audio
-                    })
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            _TTS_POOL,
+            tts.speak,
+            sentence,
+            settings.get("voice", "en-US-natalie"),  # ✅ valid voiceId
+            "mp3"
+        )
 
     except Exception as e:
+        # Report here so one failed sentence doesn't cancel the rest of the turn
         logger.error(f"TTS processing error: {e}")
         await ws_manager.send_message(session_id, {
             "type": "error",
             "text": "Audio generation failed"
         })
+        return None
+
+
+async def send_tts_audio(session_id: str, audio_tasks: asyncio.Queue, slots: asyncio.Semaphore):
+    """
+    Send synthesized audio in sentence order; a None entry ends the turn.
+
+    Each clip goes out as a small JSON header followed by one binary frame,
+    after which its lookahead slot is released for the next sentence.
+    """
+    seq = 0
+    while True:
+        task = await audio_tasks.get()
+        if task is None:
+            break
+
+        audio_bytes = await task
+        try:
+            if audio_bytes:
+                await ws_manager.send_message(session_id, {
+                    "type": "audio",
+                    "seq": seq,
+                    "bytes": len(audio_bytes)
+                })
+                await ws_manager.send_bytes(session_id, audio_bytes)
+                seq += 1
+        finally:
+            slots.release()
 
 
 @app.on_event("startup")
@@ -350,8 +518,12 @@ async def shutdown_event():
     for session_id in list(ws_manager.connections.keys()):
         await ws_manager.disconnect(session_id)
 
+    _TTS_POOL.shutdown(wait=False, cancel_futures=True)
+    llm.LLM_EXECUTOR.shutdown(wait=False, cancel_futures=True)
+
 
 if __name__ == "__main__":
+    import sys
     import uvicorn
 
     uvicorn.run(
@@ -359,5 +531,9 @@ if __name__ == "__main__":
         host="0.0.0.0",
         port=8000,
         reload=True,
-        log_level="info"
+        log_level="info",
+        # libuv-backed event loop for the WebSocket/audio I/O (not available on Windows)
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        # C-accelerated framing from the websockets package rather than wsproto
+        ws="websockets"
     )
\ No newline at end of file
@@ -4,10 +4,18 @@ from typing import List, Dict, Any, Tuple
 import re
 import os
 
-from app.services.llm import get_llm_response
+from app.services.llm import get_llm_response_async
 
 logger = logging.getLogger(__name__)
 
+# Simple search trigger detection, compiled once into a single alternation
+_TRIGGER_RE = re.compile(
+    r"\b(latest|today|yesterday|current|now|recent|"
+    r"price|cost|stock|market|news|weather|"
+    r"2024|2025|this year|last year)\b",
+    re.IGNORECASE
+)
+
 
 async def agent_response(user_query, history, api_keys: Dict[str, str] = None):
     """
@@ -16,15 +24,7 @@ async def agent_response(user_query, history, api_keys: Dict[str, str] = None):
     if api_keys is None:
         api_keys = {}
 
-    # Simple search trigger detection
-    search_triggers = [
-        "latest", "today", "yesterday", "current", "now", "recent",
-        "price", "cost", "stock", "market", "news", "weather",
-        "2024", "2025", "this year", "last year"
-    ]
-
-    query_lower = user_query.lower()
-    needs_search = any(trigger in query_lower for trigger in search_triggers)
+    needs_search = _TRIGGER_RE.search(user_query) is not None
 
     if needs_search:
         # Try web search first
@@ -39,16 +39,17 @@ Please answer the user's question: {user_query}
 
 Provide a comprehensive response that incorporates the search results with your knowledge.
 """
-                return get_llm_response(
+                return await get_llm_response_async(
                     enhanced_query,
                     history,
-                    api_keys.get("gemini")
+                    api_keys.get("gemini"),
+                    use_cache=False
                 )
         except Exception as e:
             logger.warning(f"Search failed, using LLM only: {e}")
 
-    # Use LLM for general questions
-    return get_llm_response(user_query, history, api_keys.get("gemini"))
+    # Use LLM for general questions (time-sensitive answers are never cached)
+    return await get_llm_response_async(user_query, history, api_keys.get("gemini"), use_cache=not needs_search)
 
 
 def web_search(query: str, api_key: str = None) -> str:
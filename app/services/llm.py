@@ -1,53 +1,166 @@
 # Fixed services/llm.py - Compatible with older Google Generative AI versions
 import google.generativeai as genai
 from typing import List, Dict, Any, Tuple, Optional
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+import hashlib
 import logging
 import asyncio
+import threading
 import time
 import os
+import random
+import re
 
 # Import persona
 from app.persona import merged_persona
 
 logger = logging.getLogger(__name__)
 
-# Cache for configured clients
+# Cache for configured clients: (api_key, with_persona) -> (model, system_instruction_supported, created_at)
 _client_cache = {}
 _cache_timeout = 3600
+_client_lock = threading.Lock()
+_configured_key: Optional[str] = None
 
+# LRU cache of recent responses: key -> (response text, monotonic timestamp).
+# Only the non-streaming get_llm_response/get_llm_response_async consult it;
+# streamed chat turns (send_turn) depend on session state and are never cached.
+_response_cache: "OrderedDict[bytes, Tuple[str, float]]" = OrderedDict()
+_response_cache_maxsize = 512
+_response_cache_lock = threading.Lock()
 
-def get_llm_response(user_query: str, history: List[Dict[str, Any]], api_key: str = None) -> Tuple[
-    str, List[Dict[str, Any]]]:
-    """
-    Enhanced LLM response with version compatibility for Google Generative AI.
-    """
-    # Use provided API key or fall back to environment
-    if not api_key:
-        api_key = os.getenv("GEMINI_API_KEY")
+# LRU cache of remote token counts: blake2b(text) -> total_tokens
+_token_count_cache: "OrderedDict[bytes, int]" = OrderedDict()
+_token_count_cache_maxsize = 4096
+_token_count_cache_lock = threading.Lock()
 
-    if not api_key:
-        return "Please configure your Gemini API key in the settings.", history
+MAX_RETRIES = 3
 
-    try:
-        # Configure the API key
+# Dedicated pool for blocking Gemini calls so latency spikes don't starve other work
+LLM_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix="llm")
+
+# API key validation: strict format check, then a token-free list_models probe.
+# Keys that pass are remembered (api_key -> monotonic timestamp) for _cache_timeout.
+_GEMINI_KEY_RE = re.compile(r"^AIza[0-9A-Za-z_-]{35}$")
+_VALIDATION_TIMEOUT = 10
+_validation_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="gemini-validate")
+_validated_keys: Dict[str, float] = {}
+
+
+def _response_cache_key(user_query: str, history: List[Any]) -> bytes:
+    """Hash the normalized query together with the most recent history."""
+    return hashlib.blake2b(
+        user_query.lower().strip().encode() + b"|" + repr(history[-6:]).encode()
+    ).digest()
+
+
+def _get_cached_response(key: bytes) -> Optional[str]:
+    with _response_cache_lock:
+        entry = _response_cache.get(key)
+        if entry is None:
+            return None
+
+        text, cached_at = entry
+        if time.monotonic() - cached_at > _cache_timeout:
+            del _response_cache[key]
+            return None
+
+        _response_cache.move_to_end(key)
+        return text
+
+
+def _store_cached_response(key: bytes, text: str):
+    with _response_cache_lock:
+        _response_cache[key] = (text, time.monotonic())
+        _response_cache.move_to_end(key)
+        while len(_response_cache) > _response_cache_maxsize:
+            _response_cache.popitem(last=False)
+
+
+def _configure(api_key: str):
+    """Point the process-wide genai config at api_key; callers must hold _client_lock."""
+    global _configured_key
+    if api_key != _configured_key:
         genai.configure(api_key=api_key)
+        _configured_key = api_key
+
 
-        # Create model with version compatibility check
+def _list_models(api_key: str):
+    """List models with a client bound to api_key."""
+    with _client_lock:
+        _configure(api_key)
         try:
-            # Try new version with system_instruction (v0.4.0+)
-            model = genai.GenerativeModel(
-                'gemini-1.5-flash',
-                system_instruction=merged_persona
-            )
-            logger.debug("Using GenerativeModel with system_instruction parameter")
-        except TypeError as e:
-            if "system_instruction" in str(e):
+            client = genai.client.get_default_model_client()
+        except AttributeError:
+            client = None
+
+    return genai.list_models(client=client) if client is not None else genai.list_models()
+
+
+def _get_model(api_key: str, with_persona: bool = True) -> Tuple[Any, bool]:
+    """
+    Return a cached (model, system_instruction_supported) pair for an API key.
+    """
+    cache_key = (api_key, with_persona)
+    with _client_lock:
+        entry = _client_cache.get(cache_key)
+        if entry and time.monotonic() - entry[2] < _cache_timeout:
+            return entry[0], entry[1]
+
+        _configure(api_key)
+
+        supports_system_instruction = True
+        if with_persona:
+            try:
+                # Try new version with system_instruction (v0.4.0+)
+                model = genai.GenerativeModel('gemini-1.5-flash', system_instruction=merged_persona)
+            except TypeError as e:
+                if "system_instruction" not in str(e):
+                    raise
                 # Fallback for older versions (v0.3.x)
                 model = genai.GenerativeModel('gemini-1.5-flash')
+                supports_system_instruction = False
                 logger.info("Using GenerativeModel without system_instruction (older version)")
+        else:
+            model = genai.GenerativeModel('gemini-1.5-flash')
 
-                # Prepend system instruction to the user query as a workaround
-                enhanced_query = f"""You are TechTutor Buddy, my personal AI assistant who combines:
+        # Bind the client while this key is configured so the model keeps it
+        # even after another key is configured for a different session.
+        try:
+            model._client = genai.client.get_default_generative_client()
+        except AttributeError:
+            pass
+
+        _client_cache[cache_key] = (model, supports_system_instruction, time.monotonic())
+        return model, supports_system_instruction
+
+
+def _lookup_cached_response(user_query: str, history: List[Any], use_cache: bool) -> Tuple[
+    Optional[bytes], Optional[Tuple[str, List[Any]]]]:
+    """Return the cache key for a query and the cached result, if any."""
+    if not use_cache:
+        return None, None
+
+    cache_key = _response_cache_key(user_query, history)
+    cached_text = _get_cached_response(cache_key)
+    if cached_text is None:
+        return cache_key, None
+
+    logger.debug("LLM response served from cache")
+    return cache_key, (cached_text, list(history) + [
+        {"role": "user", "parts": [user_query]},
+        {"role": "model", "parts": [cached_text]},
+    ])
+
+
+def _build_response_model(api_key: str, user_query: str):
+    """Get the Gemini model, adapting the query for older library versions."""
+    model, supports_system_instruction = _get_model(api_key)
+
+    if not supports_system_instruction:
+        # Prepend system instruction to the user query as a workaround
+        enhanced_query = f"""You are TechTutor Buddy, my personal AI assistant who combines:
 - the friendliness of a personal assistant,
 - the clarity of a patient tutor, 
 - and the enthusiasm of a tech geek.
@@ -56,53 +169,206 @@ Keep replies brief, clear, and natural to speak. Always stay under 1500 characte
 Answer directly — avoid filler or repetition. Stay in role as TechTutor Buddy.
 
 User question: {user_query}"""
-                user_query = enhanced_query
-            else:
-                raise e
+        user_query = enhanced_query
+
+    return model, user_query
+
+
+def _generate_once(model, user_query: str, history: List[Any]) -> Tuple[str, List[Any]]:
+    """Run a single chat turn against Gemini."""
+    chat = model.start_chat(history=history)
+    response = chat.send_message(user_query)
+
+    if response.text and response.text.strip():
+        return response.text.strip(), chat.history
+    raise ValueError("Empty response from model")
+
+
+def llm_error_message(e: Exception) -> str:
+    """Map a Gemini failure to a message that can be spoken to the user."""
+    error_str = str(e).upper()
+    if "API_KEY" in error_str or "INVALID" in error_str:
+        return "Invalid Gemini API key. Please check your configuration."
+    elif "QUOTA" in error_str or "LIMIT" in error_str:
+        return "API quota exceeded. Please check your Gemini API usage limits."
+    elif "NETWORK" in error_str or "CONNECTION" in error_str:
+        return "Network connectivity issue. Please check your internet connection."
+    elif "SYSTEM_INSTRUCTION" in error_str:
+        return "Using older Gemini API version. System instructions will be included in messages."
+    else:
+        return "I'm experiencing technical difficulties. Please try again in a moment."
+
+
+def get_llm_response(user_query: str, history: List[Dict[str, Any]], api_key: str = None,
+                     use_cache: bool = True) -> Tuple[str, List[Dict[str, Any]]]:
+    """
+    Enhanced LLM response with version compatibility for Google Generative AI.
+
+    Set use_cache=False for time-sensitive queries whose answers must not be reused.
+    Prefer get_llm_response_async from async code so retries don't block a worker.
+    """
+    # Use provided API key or fall back to environment
+    if not api_key:
+        api_key = os.getenv("GEMINI_API_KEY")
+
+    if not api_key:
+        return "Please configure your Gemini API key in the settings.", history
+
+    cache_key, cached = _lookup_cached_response(user_query, history, use_cache)
+    if cached is not None:
+        return cached
+
+    try:
+        model, user_query = _build_response_model(api_key, user_query)
 
         # Generate response with retry logic
-        max_retries = 3
-        for attempt in range(max_retries):
+        for attempt in range(MAX_RETRIES):
             try:
-                chat = model.start_chat(history=history)
-                response = chat.send_message(user_query)
-
-                if response.text and response.text.strip():
-                    logger.info(f"LLM response generated successfully (attempt {attempt + 1})")
-                    return response.text.strip(), chat.history
-                else:
-                    raise ValueError("Empty response from model")
+                text, updated_history = _generate_once(model, user_query, history)
+                logger.info(f"LLM response generated successfully (attempt {attempt + 1})")
+                if cache_key is not None:
+                    _store_cached_response(cache_key, text)
+                return text, updated_history
 
             except Exception as e:
                 logger.warning(f"LLM attempt {attempt + 1} failed: {e}")
-                if attempt == max_retries - 1:
+                if attempt == MAX_RETRIES - 1:
                     raise
-                time.sleep(1)  # Brief delay before retry
+                time.sleep(0.25 * 2 ** attempt)  # Exponential backoff before retry
 
     except Exception as e:
         logger.error(f"Error getting LLM response: {e}")
 
         # Provide contextual error messages
-        error_str = str(e).upper()
-        if "API_KEY" in error_str or "INVALID" in error_str:
-            error_msg = "Invalid Gemini API key. Please check your configuration."
-        elif "QUOTA" in error_str or "LIMIT" in error_str:
-            error_msg = "API quota exceeded. Please check your Gemini API usage limits."
-        elif "NETWORK" in error_str or "CONNECTION" in error_str:
-            error_msg = "Network connectivity issue. Please check your internet connection."
-        elif "SYSTEM_INSTRUCTION" in error_str:
-            error_msg = "Using older Gemini API version. System instructions will be included in messages."
-        else:
-            error_msg = "I'm experiencing technical difficulties. Please try again in a moment."
+        return llm_error_message(e), history
+
+
+def trim_history(history: List[Any], max_messages: int = 12, keep_system: bool = True,
+                 keep_first: int = 0) -> List[Any]:
+    """
+    Keep only the most recent messages, always preserving any system message
+    and the first keep_first messages (e.g. a seeded persona exchange).
+    """
+    if not history or max_messages <= 0:
+        return list(history or [])
+
+    pinned = list(history[:keep_first])
+    history = history[keep_first:]
+
+    def role_of(message):
+        if isinstance(message, dict):
+            return message.get("role")
+        return getattr(message, "role", None)
+
+    system = [m for m in history if role_of(m) == "system"] if keep_system else []
+    rest = [m for m in history if role_of(m) != "system"] if keep_system else list(history)
+
+    if len(rest) <= max_messages:
+        return pinned + system + rest
+
+    return pinned + system + rest[-max_messages:]
+
+
+def trim_chat_history(chat, max_messages: int = 12):
+    """
+    Trim a chat session's history in place, keeping any persona seed exchange.
+    """
+    chat.history = trim_history(
+        chat.history, max_messages, keep_first=getattr(chat, "_persona_seed_len", 0)
+    )
+
+
+def create_chat_session(api_key: str = None, history: List[Dict[str, Any]] = None):
+    """
+    Create a Gemini chat session that keeps conversation state across turns.
+    """
+    # Use provided API key or fall back to environment
+    if not api_key:
+        api_key = os.getenv("GEMINI_API_KEY")
+
+    model, supports_system_instruction = _get_model(api_key)
+    history = list(history or [])
 
-        return error_msg, history
+    seed = []
+    if not supports_system_instruction:
+        # Fallback for older versions: seed the persona as the opening exchange
+        seed = [
+            {"role": "user", "parts": [merged_persona]},
+            {"role": "model", "parts": ["Understood."]},
+        ]
 
+    chat = model.start_chat(history=seed + history)
+    # Lets trim_chat_history keep the seed however long the conversation gets
+    chat._persona_seed_len = len(seed)
+    return chat
 
-async def get_llm_response_async(user_query: str, history: List[Dict[str, Any]], api_key: str = None) -> Tuple[
-    str, List[Dict[str, Any]]]:
-    """Async wrapper for LLM response."""
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, get_llm_response, user_query, history, api_key)
+
+def send_turn(chat, user_query: str):
+    """
+    Send only the new user message on an existing chat session and stream the reply text.
+
+    A failed turn is rolled back before re-raising so the session stays usable;
+    retrying is left to the (async) caller.
+    """
+    good_history = list(chat.history)
+    try:
+        response = chat.send_message(user_query, stream=True)
+        for chunk in response:
+            if chunk.text:
+                yield chunk.text
+
+        # Raises if the stream broke or finished abnormally (e.g. SAFETY)
+        chat.history
+
+    except Exception:
+        # Assigning history also drops the broken response from the session
+        chat.history = good_history
+        raise
+
+
+async def get_llm_response_async(user_query: str, history: List[Dict[str, Any]], api_key: str = None,
+                                 use_cache: bool = True) -> Tuple[str, List[Dict[str, Any]]]:
+    """
+    Async LLM response; retries back off with jittered exponential delays
+    on the event loop instead of sleeping inside an executor thread.
+    """
+    # Use provided API key or fall back to environment
+    if not api_key:
+        api_key = os.getenv("GEMINI_API_KEY")
+
+    if not api_key:
+        return "Please configure your Gemini API key in the settings.", history
+
+    cache_key, cached = _lookup_cached_response(user_query, history, use_cache)
+    if cached is not None:
+        return cached
+
+    loop = asyncio.get_running_loop()
+    try:
+        model, user_query = _build_response_model(api_key, user_query)
+
+        # Generate response with retry logic
+        for attempt in range(MAX_RETRIES):
+            try:
+                text, updated_history = await loop.run_in_executor(
+                    LLM_EXECUTOR, _generate_once, model, user_query, history
+                )
+                logger.info(f"LLM response generated successfully (attempt {attempt + 1})")
+                if cache_key is not None:
+                    _store_cached_response(cache_key, text)
+                return text, updated_history
+
+            except Exception as e:
+                logger.warning(f"LLM attempt {attempt + 1} failed: {e}")
+                if attempt == MAX_RETRIES - 1:
+                    raise
+                await asyncio.sleep(min(8, 0.25 * 2 ** attempt) + random.random() * 0.1)
+
+    except Exception as e:
+        logger.error(f"Error getting LLM response: {e}")
+
+        # Provide contextual error messages
+        return llm_error_message(e), history
 
 
 def validate_gemini_api_key(api_key: str) -> Tuple[bool, str]:
@@ -110,31 +376,25 @@ def validate_gemini_api_key(api_key: str) -> Tuple[bool, str]:
     if not api_key or not api_key.strip():
         return False, "API key is empty"
 
-    if not api_key.startswith("AIza"):
+    api_key = api_key.strip()
+    if not _GEMINI_KEY_RE.match(api_key):
         return False, "Invalid API key format"
 
-    try:
-        # Test the API key
-        genai.configure(api_key=api_key)
-
-        # Try with different model initialization approaches
-        try:
-            model = genai.GenerativeModel('gemini-1.5-flash')
-        except Exception:
-            # Fallback to older model name if needed
-            try:
-                model = genai.GenerativeModel('gemini-pro')
-            except Exception as model_err:
-                return False, f"Model initialization failed: {str(model_err)}"
+    validated_at = _validated_keys.get(api_key)
+    if validated_at is not None and time.monotonic() - validated_at < _cache_timeout:
+        return True, "API key is valid"
 
-        # Send a minimal test message
-        test_response = model.generate_content("Hello", stream=False)
+    try:
+        # Test the API key by listing models, which succeeds for valid keys without using tokens
+        probe = _validation_pool.submit(lambda: next(iter(_list_models(api_key)), None))
+        probe.result(timeout=_VALIDATION_TIMEOUT)
 
-        if test_response and test_response.text:
-            return True, "API key is valid"
-        else:
-            return False, "API key test failed"
+        _validated_keys[api_key] = time.monotonic()
+        return True, "API key is valid"
 
+    except FutureTimeoutError:
+        logger.warning("API key validation timed out")
+        return False, "API key validation timed out"
     except Exception as e:
         logger.warning(f"API key validation failed: {e}")
         error_msg = str(e)
@@ -149,8 +409,7 @@ def validate_gemini_api_key(api_key: str) -> Tuple[bool, str]:
 def get_available_models(api_key: str) -> List[str]:
     """Get available models with fallback for different API versions."""
     try:
-        genai.configure(api_key=api_key)
-        models = genai.list_models()
+        models = _list_models(api_key)
 
         model_names = []
         for model in models:
@@ -182,8 +441,7 @@ class EnhancedLLMService:
     def get_model_info(api_key: str) -> Dict[str, Any]:
         """Get available models information with version compatibility."""
         try:
-            genai.configure(api_key=api_key)
-            models = genai.list_models()
+            models = _list_models(api_key)
 
             model_list = []
             for model in models:
@@ -212,19 +470,8 @@ class EnhancedLLMService:
     def check_system_instruction_support(api_key: str) -> bool:
         """Check if the current API version supports system_instruction."""
         try:
-            genai.configure(api_key=api_key)
-
-            # Try to create a model with system_instruction
-            test_model = genai.GenerativeModel(
-                'gemini-1.5-flash',
-                system_instruction="Test"
-            )
-            return True
-
-        except TypeError as e:
-            if "system_instruction" in str(e):
-                return False
-            return True  # Other errors don't indicate lack of support
+            _, supports_system_instruction = _get_model(api_key)
+            return supports_system_instruction
         except Exception:
             return False
 
@@ -232,19 +479,10 @@ class EnhancedLLMService:
     def generate_streaming_response(user_query: str, history: List[Dict[str, Any]], api_key: str):
         """Generate streaming response with version compatibility."""
         try:
-            genai.configure(api_key=api_key)
-
-            # Try with system instruction first
-            try:
-                model = genai.GenerativeModel('gemini-1.5-flash', system_instruction=merged_persona)
-            except TypeError as e:
-                if "system_instruction" in str(e):
-                    # Fallback for older versions
-                    model = genai.GenerativeModel('gemini-1.5-flash')
-                    # Prepend system instruction to query
-                    user_query = f"System: {merged_persona}\n\nUser: {user_query}"
-                else:
-                    raise e
+            model, supports_system_instruction = _get_model(api_key)
+            if not supports_system_instruction:
+                # Fallback for older versions: prepend system instruction to query
+                user_query = f"System: {merged_persona}\n\nUser: {user_query}"
 
             chat = model.start_chat(history=history)
             response = chat.send_message(user_query, stream=True)
@@ -260,10 +498,22 @@ class EnhancedLLMService:
     @staticmethod
     def get_token_count(text: str, api_key: str) -> int:
         """Get approximate token count for text."""
+        text_hash = hashlib.blake2b(text.encode()).digest()
+        with _token_count_cache_lock:
+            cached = _token_count_cache.get(text_hash)
+            if cached is not None:
+                _token_count_cache.move_to_end(text_hash)
+                return cached
+
         try:
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel('gemini-1.5-flash')
+            model, _ = _get_model(api_key, with_persona=False)
             count_result = model.count_tokens(text)
+
+            with _token_count_cache_lock:
+                _token_count_cache[text_hash] = count_result.total_tokens
+                while len(_token_count_cache) > _token_count_cache_maxsize:
+                    _token_count_cache.popitem(last=False)
+
             return count_result.total_tokens
         except Exception as e:
             logger.warning(f"Token count error: {e}")
@@ -1,13 +1,63 @@
 # Fixed services/stt.py for deployment - handles missing assemblyai.streaming
 import os
+import atexit
+import functools
 import logging
-import queue
 import threading
+from collections import deque
 from typing import Optional, Callable, Dict, Any
 import time
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__name__)
 
+# Pooled keep-alive session for AssemblyAI REST calls, so repeated key checks
+# reuse the TLS connection instead of handshaking every time
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    max_retries=Retry(total=2, backoff_factor=0.2)
+))
+_SESSION.headers.update({"User-Agent": "voice-agent/1.0"})
+atexit.register(_SESSION.close)
+
+# Fallback API key when callers don't supply one
+_DEFAULT_KEY = os.getenv("ASSEMBLYAI_API_KEY", "")
+
+# How long a definitive API key validation result is reused
+_VALIDATION_TTL = 3600
+
+# Runs key validation alongside the streaming connect in the constructor
+_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix="aai-validate")
+
+# How long a failed connect waits on the parallel validation result
+_VALIDATION_WAIT = 5
+
+# Keys that have validated successfully in this process; the streaming
+# connection itself still surfaces a key that has since been revoked
+_VALID_KEYS: set[str] = set()
+
+# Browser buffers are coalesced into packets of at least this much audio
+# (or whatever has accumulated after this long) before going to AssemblyAI
+COALESCE_SECONDS = 0.1
+
+# AssemblyAI rejects messages shorter than this, so a time-based flush waits
+# until at least this much audio has accumulated
+MIN_PACKET_SECONDS = 0.05
+
+# Bound on queued audio packets; when full the oldest packet is dropped,
+# since stale audio is worthless for live transcription
+MAX_QUEUED_CHUNKS = 500
+
+# Upper bound on the audio joined into one batch per wake-up; AssemblyAI
+# closes the session on messages longer than 1000 ms
+MAX_BATCH_SECONDS = 1.0
+
 # Try to import AssemblyAI with fallback
 ASSEMBLYAI_AVAILABLE = False
 STREAMING_AVAILABLE = False
@@ -84,8 +134,7 @@ class AssemblyAIStreamingTranscriber:
             enable_format_text: bool = True,
     ):
         # Use provided API key or environment variable
-        if not api_key:
-            api_key = os.getenv("ASSEMBLYAI_API_KEY")
+        api_key = api_key or _DEFAULT_KEY
 
         if not api_key:
             raise ValueError("AssemblyAI API key is required")
@@ -98,6 +147,13 @@ class AssemblyAIStreamingTranscriber:
         self.enable_automatic_punctuation = enable_automatic_punctuation
         self.enable_format_text = enable_format_text
 
+        # Session statistics
+        self._start_time: Optional[float] = None
+        self._end_time: Optional[float] = None
+        self._total_audio_duration = 0
+        self._turns_processed = 0
+        self._errors_count = 0
+
         # Check service availability
         if not ASSEMBLYAI_AVAILABLE:
             raise ImportError("AssemblyAI library is not installed")
@@ -110,64 +166,98 @@ class AssemblyAIStreamingTranscriber:
         # Configure AssemblyAI
         aai.settings.api_key = self.api_key
 
+        # Event handlers registered on every client this transcriber builds
+        self._handlers = (
+            (StreamingEvents.Begin, _on_begin),
+            (StreamingEvents.Error, self._on_error),
+            (StreamingEvents.Termination, _on_termination),
+            (StreamingEvents.Turn, self._on_turn),
+        ) if StreamingEvents else ()
+
         # Initialize streaming client
         try:
-            self.client = StreamingClient(
-                StreamingClientOptions(
-                    api_key=self.api_key,
-                    api_host="streaming.assemblyai.com",
-                )
-            )
-
-            # Register event handlers
-            if StreamingEvents:
-                self.client.on(StreamingEvents.Begin, _on_begin)
-                self.client.on(StreamingEvents.Error, self._on_error)
-                self.client.on(StreamingEvents.Termination, _on_termination)
-                self.client.on(StreamingEvents.Turn, self._on_turn)
-
+            self.client = self._build_client()
         except Exception as e:
             logger.error(f"Failed to initialize streaming client: {e}")
             self._init_fallback_transcriber()
             return
 
         # Internal streaming state
-        self._q: "queue.Queue[Optional[bytes]]" = queue.Queue()
+        self._q: "deque[Optional[bytes]]" = deque(maxlen=MAX_QUEUED_CHUNKS)
+        self._q_cv = threading.Condition()
+        self._accum = bytearray()
+        self._min_chunk_bytes = int(self.sample_rate * 2 * COALESCE_SECONDS)  # 16-bit mono PCM
+        self._min_packet_bytes = int(self.sample_rate * 2 * MIN_PACKET_SECONDS)
+        self._max_batch_bytes = int(self.sample_rate * 2 * MAX_BATCH_SECONDS)
+        self._last_flush = time.monotonic()
         self._thread: Optional[threading.Thread] = None
-        self._connected = threading.Event()
+        self._connect_barrier = threading.Barrier(2, timeout=10)
+        self._connect_error: Optional[BaseException] = None
         self._session_id: Optional[str] = None
-        self._stats = {
-            "start_time": None,
-            "end_time": None,
-            "total_audio_duration": 0,
-            "turns_processed": 0,
-            "errors_count": 0
-        }
+        self._format_requested = False
+        self._format_params = StreamingSessionParameters(
+            format_turns=True,
+            language_code=self.language_code,
+            punctuate=self.enable_automatic_punctuation
+        )
         self._use_fallback = False
 
+        # Validate the key in parallel with the connect; only consulted if it fails
+        self._validation_future: Optional[Future] = (
+            None if self.api_key in _VALID_KEYS
+            else _EXECUTOR.submit(_check_api_key, self.api_key)
+        )
+
         # Start background streaming thread
         try:
             self._start_background_stream()
         except Exception as e:
             logger.error(f"Failed to start streaming: {e}")
+            self._raise_if_key_invalid()
             self._init_fallback_transcriber()
 
+    def _raise_if_key_invalid(self):
+        """Surface a rejected API key instead of silently degrading to the fallback."""
+        if self._validation_future is None:
+            return
+        try:
+            is_valid, message = self._validation_future.result(timeout=_VALIDATION_WAIT)
+        except Exception:
+            return  # No definitive answer (timeout, network, 5xx); keep the fallback behaviour
+        if not is_valid:
+            raise STTConfigurationError(f"AssemblyAI API key rejected: {message}")
+
+    def _build_client(self):
+        """Create a streaming client with this transcriber's event handlers attached."""
+        client = StreamingClient(
+            StreamingClientOptions(
+                api_key=self.api_key,
+                api_host="streaming.assemblyai.com",
+            )
+        )
+        for event, handler in self._handlers:
+            client.on(event, handler)
+        return client
+
     def _init_fallback_transcriber(self):
         """Initialize fallback transcriber when streaming is not available."""
         self._use_fallback = True
         self.client = None
-        self._q = queue.Queue()
+        self._q = deque(maxlen=MAX_QUEUED_CHUNKS)
+        self._q_cv = threading.Condition()
         self._thread = None
-        self._connected = threading.Event()
-        self._connected.set()  # Mark as "connected" for fallback mode
 
         logger.info("Initialized fallback transcriber (streaming not available)")
 
     def _on_error(self, client, error):
         """Enhanced error handler."""
-        logger.error("AssemblyAI streaming error: %s", error)
-        if hasattr(self, '_stats'):
-            self._stats["errors_count"] += 1
+        self._errors_count += 1
+        # Classify by type/code rather than by matching on the message text
+        if isinstance(error, (ConnectionError, TimeoutError)):
+            logger.warning("AssemblyAI connection error: %s", error)
+        else:
+            logger.error("AssemblyAI streaming error (code=%s): %s",
+                         getattr(error, "code", None), error)
 
     def _on_turn(self, client, event):
         """Enhanced turn handler."""
@@ -175,70 +265,52 @@ class AssemblyAIStreamingTranscriber:
             if not event:
                 return
 
-            text = getattr(event, 'transcript', '') or ""
-            text = text.strip()
-            if not text:
+            text = getattr(event, 'transcript', '')
+            if not text or text.isspace():
                 return
 
             # Update statistics
-            if hasattr(self, '_stats'):
-                self._stats["turns_processed"] += 1
-
-            # Process text
-            processed_text = self._process_transcript_text(text)
+            self._turns_processed += 1
 
             end_of_turn = getattr(event, 'end_of_turn', False)
 
+            # Text is only cleaned on the branch whose callback will consume it
             if end_of_turn:
                 if self.on_final_callback:
                     try:
-                        self.on_final_callback(processed_text)
+                        self.on_final_callback(self._process_transcript_text(text))
                     except Exception as cb_err:
                         logger.exception("Final-callback error: %s", cb_err)
 
-                # Enable formatted turns for better accuracy
+                # Enable formatted turns for better accuracy (once per session)
                 turn_is_formatted = getattr(event, 'turn_is_formatted', False)
-                if not turn_is_formatted and self.client and StreamingSessionParameters:
+                if not self._format_requested and not turn_is_formatted and self.client:
                     try:
-                        self.client.set_params(StreamingSessionParameters(
-                            format_turns=True,
-                            language_code=self.language_code,
-                            punctuate=self.enable_automatic_punctuation
-                        ))
+                        self.client.set_params(self._format_params)
+                        self._format_requested = True
                     except Exception as set_err:
                         logger.warning("set_params error: %s", set_err)
             else:
                 if self.on_partial_callback:
                     try:
-                        self.on_partial_callback(processed_text)
+                        self.on_partial_callback(self._process_transcript_text(text))
                     except Exception as cb_err:
                         logger.exception("Partial-callback error: %s", cb_err)
 
         except Exception as e:
             logger.exception("Error in turn handler: %s", e)
-            if hasattr(self, '_stats'):
-                self._stats["errors_count"] += 1
+            self._errors_count += 1
 
     def _process_transcript_text(self, text: str) -> str:
         """Process and clean transcript text."""
-        if not text:
-            return ""
-
-        # Basic text cleaning
-        text = text.strip()
-
-        # Remove excessive whitespace
-        import re
-        text = re.sub(r'\s+', ' ', text)
-
-        # Auto-capitalize first letter if needed
-        if text and not text[0].isupper():
-            text = text[0].upper() + text[1:]
+        # Basic text cleaning: split() with no args trims and collapses whitespace in one pass
+        text = " ".join(text.split())
 
-        return text
+        # Auto-capitalize first letter
+        return text[:1].upper() + text[1:]
 
     def stream_audio(self, audio_chunk: bytes):
-        """Feed raw audio bytes to the transcriber."""
+        """Feed raw audio (bytes or any bytes-like object) to the transcriber without copying it."""
         if self._use_fallback:
             # In fallback mode, simulate processing
             if self.on_final_callback and len(audio_chunk) > 1000:  # Simulate speech detection
@@ -249,23 +321,48 @@ class AssemblyAIStreamingTranscriber:
                     logger.error(f"Fallback callback error: {e}")
             return
 
-        if audio_chunk and self._q:
-            self._q.put(audio_chunk)
+        if not audio_chunk:
+            return
+
+        # Large enough on its own: pass through without copying
+        if not self._accum and len(audio_chunk) >= self._min_chunk_bytes:
+            self._enqueue(audio_chunk)
+            self._last_flush = time.monotonic()
+            return
+
+        self._accum += audio_chunk
+        buffered = len(self._accum)
+        if (buffered >= self._min_chunk_bytes
+                or (buffered >= self._min_packet_bytes
+                    and time.monotonic() - self._last_flush >= COALESCE_SECONDS)):
+            self._flush_audio()
+
+    def _flush_audio(self):
+        """Enqueue any coalesced audio for the streaming thread."""
+        if self._accum:
+            self._enqueue(bytes(self._accum))
+            self._accum.clear()
+        self._last_flush = time.monotonic()
+
+    def _enqueue(self, item: Optional[bytes]):
+        """Hand an audio packet (or the None end marker) to the streaming thread."""
+        with self._q_cv:
+            self._q.append(item)
+            self._q_cv.notify()
 
     def close(self):
         """Stop streaming and terminate session."""
         logger.info("Closing AssemblyAI transcriber...")
 
-        if hasattr(self, '_stats'):
-            self._stats["end_time"] = time.time()
+        self._end_time = time.monotonic()
 
         if self._use_fallback:
             logger.info("Closed fallback transcriber")
             return
 
-        # Signal generator to finish
-        if self._q:
-            self._q.put(None)
+        # Send any buffered audio, then signal generator to finish
+        self._flush_audio()
+        self._enqueue(None)
 
         if self._thread and self._thread.is_alive():
             self._thread.join(timeout=5)
@@ -275,14 +372,40 @@ class AssemblyAIStreamingTranscriber:
 
     def _audio_generator(self):
         """Generate audio chunks from queue."""
+        # Bind the hot-loop lookups once
+        q = self._q
+        q_cv = self._q_cv
+        popleft = q.popleft
+        max_batch_bytes = self._max_batch_bytes
         try:
             while True:
-                chunk = self._q.get(timeout=30)
-                if chunk is None:
+                batch = []
+                size = 0
+                done = False
+                with q_cv:
+                    if not q_cv.wait_for(lambda: q, timeout=30):
+                        logger.warning("Audio generator timeout")
+                        return
+                    # Drain what is available in one lock acquisition, without
+                    # letting a batch grow past the per-message limit
+                    while q:
+                        chunk = q[0]
+                        if chunk is None:
+                            popleft()
+                            done = True
+                            break
+                        if batch and size + len(chunk) > max_batch_bytes:
+                            break
+                        popleft()
+                        batch.append(chunk)
+                        size += len(chunk)
+
+                if len(batch) == 1:
+                    yield batch[0]
+                elif batch:
+                    yield b"".join(batch)
+                if done:
                     break
-                yield chunk
-        except queue.Empty:
-            logger.warning("Audio generator timeout")
         except Exception as e:
             logger.error(f"Audio generator error: {e}")
 
@@ -293,8 +416,7 @@ class AssemblyAIStreamingTranscriber:
 
         def runner():
             try:
-                if hasattr(self, '_stats'):
-                    self._stats["start_time"] = time.time()
+                self._start_time = time.monotonic()
 
                 # Connect with parameters
                 self.client.connect(
@@ -306,15 +428,19 @@ class AssemblyAIStreamingTranscriber:
                         format_text=self.enable_format_text
                     )
                 )
-                self._connected.set()
+                self._connect_barrier.wait()
 
                 # Stream audio from generator
                 self.client.stream(self._audio_generator())
 
+            except threading.BrokenBarrierError:
+                logger.error("AssemblyAI connect handshake abandoned")
             except Exception as e:
                 logger.exception("AssemblyAI streaming thread crashed: %s", e)
-                if hasattr(self, '_stats'):
-                    self._stats["errors_count"] += 1
+                self._errors_count += 1
+                # Release the constructor immediately instead of letting it time out
+                self._connect_error = e
+                self._connect_barrier.abort()
             finally:
                 try:
                     if self.client:
@@ -325,34 +451,40 @@ class AssemblyAIStreamingTranscriber:
         self._thread = threading.Thread(target=runner, daemon=True)
         self._thread.start()
 
-        # Wait for connection with timeout
-        if not self._connected.wait(timeout=10):
+        # Rendezvous with the streaming thread once it has connected
+        try:
+            self._connect_barrier.wait()
+        except threading.BrokenBarrierError:
+            if self._connect_error is not None:
+                logger.error("AssemblyAI connection failed")
+                raise STTConnectionError(
+                    f"Failed to connect to AssemblyAI: {self._connect_error}"
+                ) from self._connect_error
             logger.error("AssemblyAI connection timeout")
             raise TimeoutError("Failed to connect to AssemblyAI within 10 seconds")
 
     def _log_session_stats(self):
         """Log session statistics."""
-        if not hasattr(self, '_stats'):
-            return
-
-        if self._stats["start_time"] and self._stats["end_time"]:
-            duration = self._stats["end_time"] - self._stats["start_time"]
+        if self._start_time and self._end_time:
+            duration = self._end_time - self._start_time
             logger.info(
                 f"AssemblyAI session stats: "
                 f"Duration: {duration:.1f}s, "
-                f"Turns: {self._stats['turns_processed']}, "
-                f"Errors: {self._stats['errors_count']}"
+                f"Turns: {self._turns_processed}, "
+                f"Errors: {self._errors_count}"
             )
 
     def get_stats(self) -> Dict[str, Any]:
         """Get current session statistics."""
-        if not hasattr(self, '_stats'):
-            return {}
-
-        stats = self._stats.copy()
-        if self._stats["start_time"]:
-            current_time = time.time()
-            stats["current_duration"] = current_time - self._stats["start_time"]
+        stats = {
+            "start_time": self._start_time,
+            "end_time": self._end_time,
+            "total_audio_duration": self._total_audio_duration,
+            "turns_processed": self._turns_processed,
+            "errors_count": self._errors_count,
+        }
+        if self._start_time:
+            stats["current_duration"] = time.monotonic() - self._start_time
         return stats
 
 
@@ -362,6 +494,45 @@ def create_transcriber(api_key: str = None, **kwargs) -> AssemblyAIStreamingTran
     return AssemblyAIStreamingTranscriber(api_key=api_key, **kwargs)
 
 
+@functools.lru_cache(maxsize=128)
+def _validate_cached(api_key: str, bucket: int) -> tuple[bool, str]:
+    """
+    Check an API key against AssemblyAI. Results are cached per key for the
+    current TTL bucket; network errors and non-definitive statuses (5xx, 429,
+    ...) raise and so are never cached.
+    """
+    # Test API key by making a simple request
+    headers = {"authorization": api_key}
+    response = _SESSION.get(
+        "https://api.assemblyai.com/v2/user",
+        headers=headers,
+        timeout=10
+    )
+
+    if response.status_code == 200:
+        return True, "API key is valid"
+    elif response.status_code == 401:
+        return False, "Invalid API key"
+    elif response.status_code == 403:
+        return False, "API key lacks required permissions"
+    else:
+        raise STTAPIError(f"API validation failed: HTTP {response.status_code}")
+
+
+def _check_api_key(api_key: str) -> tuple[bool, str]:
+    """
+    Definitive validation result for a key; raises when AssemblyAI could not
+    give one (network errors, transient HTTP statuses).
+    """
+    if api_key in _VALID_KEYS:
+        return True, "API key is valid (cached)"
+
+    is_valid, message = _validate_cached(api_key, int(time.time() // _VALIDATION_TTL))
+    if is_valid:
+        _VALID_KEYS.add(api_key)
+    return is_valid, message
+
+
 def validate_api_key(api_key: str) -> tuple[bool, str]:
     """Validate AssemblyAI API key."""
     if not api_key or not api_key.strip():
@@ -371,25 +542,10 @@ def validate_api_key(api_key: str) -> tuple[bool, str]:
         return False, "AssemblyAI library not available"
 
     try:
-        # Test API key by making a simple request
-        import requests
-
-        headers = {"authorization": api_key}
-        response = requests.get(
-            "https://api.assemblyai.com/v2/user",
-            headers=headers,
-            timeout=10
-        )
-
-        if response.status_code == 200:
-            return True, "API key is valid"
-        elif response.status_code == 401:
-            return False, "Invalid API key"
-        elif response.status_code == 403:
-            return False, "API key lacks required permissions"
-        else:
-            return False, f"API validation failed: HTTP {response.status_code}"
+        return _check_api_key(api_key)
 
+    except STTAPIError as e:
+        return False, str(e)
     except requests.exceptions.Timeout:
         return False, "API request timeout"
     except requests.exceptions.ConnectionError:
@@ -405,10 +561,8 @@ def get_account_info(api_key: str) -> Dict[str, Any]:
         return {"error": "AssemblyAI library not available"}
 
     try:
-        import requests
-
         headers = {"authorization": api_key}
-        response = requests.get(
+        response = _SESSION.get(
             "https://api.assemblyai.com/v2/user",
             headers=headers,
             timeout=10
@@ -432,8 +586,7 @@ class AssemblyAIStreamingTranscriberLegacy(AssemblyAIStreamingTranscriber):
             sample_rate: int = 16000,
             api_key: str = None
     ):
-        if not api_key:
-            api_key = os.getenv("ASSEMBLYAI_API_KEY", "")
+        api_key = api_key or _DEFAULT_KEY
 
         super().__init__(
             api_key=api_key,
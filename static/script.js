@@ -74,8 +74,7 @@
             const playNextInQueue = () => {
                 if (audioQueue.length > 0 && audioEnabled) {
                     isPlaying = true;
-                    const base64Audio = audioQueue.shift();
-                    const audioData = Uint8Array.from(atob(base64Audio), c => c.charCodeAt(0)).buffer;
+                    const audioData = audioQueue.shift();
 
                     audioContext.decodeAudioData(audioData).then(buffer => {
                         const source = audioContext.createBufferSource();
@@ -167,6 +166,7 @@
 
                     const wsProtocol = window.location.protocol === "https:" ? "wss:" : "ws:";
                     ws = new WebSocket(`${wsProtocol}//${window.location.host}/ws`);
+                    ws.binaryType = "arraybuffer";
 
                     ws.onopen = () => {
                         console.log("✅ WebSocket connected");
@@ -176,15 +176,18 @@
                     };
 
                     ws.onmessage = (event) => {
+                        // Binary frames carry the audio announced by the preceding "audio" header
+                        if (event.data instanceof ArrayBuffer) {
+                            audioQueue.push(event.data);
+                            if (!isPlaying) playNextInQueue();
+                            return;
+                        }
                         const msg = JSON.parse(event.data);
                         if (msg.type === "assistant") {
                             addOrUpdateMessage(msg.text, "assistant", msg.diagram);
                         } else if (msg.type === "final") {
                             addOrUpdateMessage(msg.text, "user");
                             showTypingIndicator();
-                        } else if (msg.type === "audio") {
-                            audioQueue.push(msg.b64);
-                            if (!isPlaying) playNextInQueue();
                         }
                     };
 